@@ -1,41 +1,456 @@
+# Patch the stdlib before pymongo/requests are imported so their I/O yields to gevent
+import gevent
+from gevent import monkey
+monkey.patch_all()
+
 from flask import Flask, request, abort
+from flask.logging import default_handler
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from twilio.request_validator import RequestValidator
+from twilio.base.exceptions import TwilioRestException
+from requests.adapters import HTTPAdapter
 import pymongo
+import pymongo.errors
+from bson import ObjectId
 from datetime import datetime, timedelta
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
 import os
 from dotenv import load_dotenv
-from apscheduler.schedulers.background import BackgroundScheduler
-import json
+from cachetools import TTLCache
+from apscheduler.schedulers.gevent import GeventScheduler
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import queue
+import re
+import socket
+import threading
+import time
 
 load_dotenv()
 
 app = Flask(__name__)
 
-# Enhanced logging
-handler = RotatingFileHandler('appointment_bot.log', maxBytes=10000, backupCount=3)
-handler.setLevel(logging.DEBUG)
+class NativeThreadQueueListener(QueueListener):
+    # monkey.patch_all() turns threading.Thread into a greenlet on the hub's thread, where
+    # file writes would still block every request; run the listener on a real OS thread
+    def start(self):
+        self._done = monkey.get_original('_thread', 'allocate_lock')()
+        self._done.acquire()
+        monkey.get_original('_thread', 'start_new_thread')(self._run, ())
+
+    def _run(self):
+        try:
+            self._monitor()
+        finally:
+            self._done.release()
+
+    def stop(self):
+        self.enqueue_sentinel()
+        self._done.acquire()
+
+# Enhanced logging; QueueHandler formats each record on the calling side and enqueues
+# it, while writing and rotation happen on the listener's OS thread
+log_level = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+handler = RotatingFileHandler('appointment_bot.log', maxBytes=10 * 1024 * 1024, backupCount=5)
+# Only the listener thread uses the handler, so give it a native lock rather than a patched one
+handler.lock = monkey.get_original('_thread', 'RLock')()
+handler.setLevel(log_level)
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
-app.logger.addHandler(handler)
-app.logger.setLevel(logging.DEBUG)
+# The unpatched SimpleQueue blocks the listener's OS thread in get() without touching the hub
+log_queue = monkey.get_original('queue', 'SimpleQueue')()
+log_listener = NativeThreadQueueListener(log_queue, handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+# Flask's default stderr handler would still write every record synchronously on the request greenlet
+app.logger.removeHandler(default_handler)
+app.logger.addHandler(QueueHandler(log_queue))
+app.logger.setLevel(log_level)
 
 # Twilio credentials
-account_sid = ''
-auth_token = ''
-twilio_client = Client(account_sid, auth_token)
+account_sid = os.environ.get('TWILIO_ACCOUNT_SID', '')
+auth_token = os.environ.get('TWILIO_AUTH_TOKEN', '')
+
+# Twilio WhatsApp sender every outbound message goes from
+FROM_WHATSAPP = os.environ.get('TWILIO_WHATSAPP_FROM', 'whatsapp:+14155238886')
 
 # MongoDB connection
-mongo_uri = 'mongodb://localhost:27017/'
-client = pymongo.MongoClient(mongo_uri)
-db = client['appointment_db']
-appointments = db['appointments']
+mongo_uri = os.environ.get('MONGO_URI', 'mongodb://localhost:27017/')
+
+# A hung Twilio request must not pin a dispatcher slot forever
+TWILIO_TIMEOUT_SECONDS = 10
+
+# Clients are created on first use, so requests that never touch Twilio or
+# Mongo don't pay for the handshakes
+@lru_cache(maxsize=1)
+def get_twilio():
+    http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_TIMEOUT_SECONDS)
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=20)
+    http_client.session.mount('https://', adapter)
+    return Client(account_sid, auth_token, http_client=http_client)
+
+@lru_cache(maxsize=1)
+def get_mongo():
+    return pymongo.MongoClient(
+        mongo_uri,
+        maxPoolSize=50,
+        minPoolSize=5,
+        serverSelectionTimeoutMS=3000,
+        socketTimeoutMS=5000
+    )
+
+@lru_cache(maxsize=1)
+def get_validator():
+    return RequestValidator(auth_token)
+
+def _reset_clients():
+    # Forked workers must open their own sockets instead of sharing the parent's
+    get_twilio.cache_clear()
+    get_mongo.cache_clear()
+
+os.register_at_fork(after_in_child=_reset_clients)
+
+def get_appointments():
+    return get_mongo()['appointment_db']['appointments']
+
+# Reminders go out a day ahead; follow-ups are sent for up to a day afterwards
+REMINDER_LEAD_TIME = timedelta(hours=24)
+FOLLOW_UP_WINDOW = timedelta(hours=24)
+# Jobs due within this window are loaded into the scheduler at startup and on each hourly reseed
+SEED_HORIZON = timedelta(hours=24)
+CHANGE_STREAM_RETRY_SECONDS = 5
+CHANGE_STREAM_HISTORY_LOST = 286
+SCHEDULER_RETRY_SECONDS = 10
+
+REMINDER_INDEX = [("reminder_sent", pymongo.ASCENDING), ("reminder_due_at", pymongo.ASCENDING)]
+FOLLOW_UP_INDEX = [("follow_up_sent", pymongo.ASCENDING), ("follow_up_due_at", pymongo.ASCENDING)]
+
+def ensure_indexes():
+    appointments = get_appointments()
+    # Partial indexes only hold unsent rows, so they stay small enough to live in RAM
+    appointments.create_index(
+        REMINDER_INDEX,
+        partialFilterExpression={"reminder_sent": False}
+    )
+    appointments.create_index(
+        FOLLOW_UP_INDEX,
+        partialFilterExpression={"follow_up_sent": False}
+    )
+    # Upcoming-appointment lookup used by cancel_booking
+    appointments.create_index([("phone_number", pymongo.ASCENDING), ("appointment_date", pymongo.ASCENDING)])
+
+def backfill_due_dates():
+    # Appointments booked before the due_at fields existed would otherwise never be picked up
+    result = get_appointments().update_many(
+        {"reminder_due_at": {"$exists": False}},
+        [{"$set": {
+            "reminder_due_at": {"$subtract": ["$appointment_date", int(REMINDER_LEAD_TIME.total_seconds() * 1000)]},
+            "follow_up_due_at": "$appointment_date"
+        }}]
+    )
+    if result.modified_count:
+        app.logger.info(f"Backfilled due dates on {result.modified_count} appointments.")
+
+# Outbound message dispatch (Twilio allows roughly 1-10 messages per second)
+SEND_MAX_WORKERS = 20
+SEND_RATE_PER_SECOND = 10
+# Every worker runs its own dispatcher, so the budget is shared between them.
+# gunicorn.conf.py exports WEB_CONCURRENCY; the limit is per host, not global.
+WEB_CONCURRENCY = max(int(os.getenv('WEB_CONCURRENCY', 1)), 1)
+# The worker running the scheduler sends every reminder and follow-up, so it gets most
+# of the budget; the other workers only send the odd greeting
+SCHEDULER_SEND_SHARE = 0.75
+
+# Only processes started with RUN_SCHEDULER=1 run the reminder/follow-up jobs
+RUN_SCHEDULER = os.environ.get("RUN_SCHEDULER") == "1"
+
+def worker_send_rate(runs_scheduler):
+    if WEB_CONCURRENCY == 1:
+        return SEND_RATE_PER_SECOND
+    if not RUN_SCHEDULER:
+        return SEND_RATE_PER_SECOND / WEB_CONCURRENCY
+    if runs_scheduler:
+        return SEND_RATE_PER_SECOND * SCHEDULER_SEND_SHARE
+    return SEND_RATE_PER_SECOND * (1 - SCHEDULER_SEND_SHARE) / (WEB_CONCURRENCY - 1)
+BULK_WRITE_BATCH_SIZE = 500
+
+# Outbox: messages are persisted, queued in memory and sent by a background dispatcher
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_BACKOFF_SECONDS = 2
+OUTBOX_TTL_SECONDS = 24 * 60 * 60
+# Each entry is leased to the process that queued it; the lease is renewed while that
+# process is alive, and entries with an expired lease are reclaimed by the scheduler
+OUTBOX_LEASE = timedelta(minutes=5)
+OUTBOX_LEASE_RENEW_SECONDS = 30
+OUTBOX_RECOVERY_MINUTES = 1
+OUTBOX_FLUSH_SECONDS = 1
+
+# Only the fields the reminder/follow-up messages actually use
+APPOINTMENT_PROJECTION = {"_id": 1, "service": 1, "phone_number": 1, "appointment_date": 1}
+SCAN_BATCH_SIZE = 200
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.capacity = max(rate, 1)
+            self.tokens = min(self.tokens, self.capacity)
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                # Sleep off the deficit so we never exceed the configured rate
+                time.sleep((1 - self.tokens) / self.rate)
+                self.last = time.monotonic()
+                self.tokens = 1
+            self.tokens -= 1
+
+OUTBOX = queue.Queue()
+# Raised to the scheduler's share once this process starts the scheduler
+OUTBOX_BUCKET = TokenBucket(worker_send_rate(runs_scheduler=False))
+_outbox_dispatcher_pid = None
+_outbox_dispatcher_lock = threading.Lock()
+
+def get_outbox():
+    return get_mongo()['appointment_db']['outbox']
+
+def ensure_outbox_indexes():
+    outbox = get_outbox()
+    # Entries a dead process never delivered expire instead of piling up
+    outbox.create_index("created_at", expireAfterSeconds=OUTBOX_TTL_SECONDS)
+    outbox.create_index("locked_until")
+    outbox.create_index("owner")
+
+def outbox_owner():
+    # Evaluated per call so forked workers get their own identity
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def outbox_item(to, body, appointment_id=None, field=None, **params):
+    return {
+        "_id": ObjectId(),
+        "to": to,
+        "body": body,
+        "params": params,
+        "appointment_id": appointment_id,
+        "field": field,
+        "attempts": 0,
+        "created_at": datetime.utcnow(),
+        "owner": outbox_owner(),
+        "locked_until": datetime.utcnow() + OUTBOX_LEASE
+    }
+
+def enqueue_messages(items):
+    if not items:
+        return
+    try:
+        get_outbox().insert_many(items, ordered=False)
+    except Exception as e:
+        # Still send; we only lose crash recovery for these messages
+        app.logger.error(f"Failed to persist {len(items)} outbox messages: {str(e)}")
+    start_outbox_dispatcher()
+    for item in items:
+        OUTBOX.put(item)
+
+def enqueue_message(to, body, **kwargs):
+    enqueue_messages([outbox_item(to, body, **kwargs)])
+
+def renew_outbox_leases():
+    # Covers everything this process holds: queued, in flight or waiting for a retry
+    try:
+        get_outbox().update_many(
+            {"owner": outbox_owner()},
+            {"$set": {"locked_until": datetime.utcnow() + OUTBOX_LEASE}}
+        )
+    except Exception as e:
+        app.logger.error(f"Failed to renew outbox leases: {str(e)}")
+
+def recover_outbox():
+    # Entries whose lease ran out belong to a process that died before sending them;
+    # each one is claimed atomically so two recoveries never requeue the same entry
+    outbox = get_outbox()
+    owner = outbox_owner()
+    recovered = 0
+    while True:
+        now = datetime.utcnow()
+        item = outbox.find_one_and_update(
+            {"locked_until": {"$lte": now}},
+            {"$set": {"owner": owner, "locked_until": now + OUTBOX_LEASE}},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if item is None:
+            break
+        start_outbox_dispatcher()
+        OUTBOX.put(item)
+        recovered += 1
+    if recovered:
+        app.logger.info(f"Requeued {recovered} undelivered outbox messages.")
+
+def start_outbox_dispatcher():
+    global _outbox_dispatcher_pid
+    with _outbox_dispatcher_lock:
+        if _outbox_dispatcher_pid == os.getpid():
+            return
+        threading.Thread(target=dispatch_outbox, name="outbox-dispatcher", daemon=True).start()
+        _outbox_dispatcher_pid = os.getpid()
+
+def send_outbox_item(twilio_client, item):
+    return twilio_client.messages.create(
+        from_=FROM_WHATSAPP,
+        to=item["to"],
+        body=item["body"],
+        **item["params"]
+    )
+
+# Twilio error codes that are about this one message or recipient and will fail the same
+# way every time. Account-wide failures (401/403/404 from bad credentials or a wrong
+# account SID) are left to the normal retries so no messages are dropped for them.
+PERMANENT_TWILIO_ERROR_CODES = frozenset({
+    21211,  # Invalid 'To' phone number
+    21408,  # Permission to send to this region is not enabled
+    21610,  # Recipient has unsubscribed
+    21612,  # 'To' number cannot be reached on this route
+    21614,  # 'To' number is not a valid mobile number
+    21617,  # Message body exceeds the length limit
+    63003,  # Channel could not find the 'To' address
+    63016,  # Outside the WhatsApp 24-hour session window
+})
+
+def is_permanent_send_error(error):
+    return isinstance(error, TwilioRestException) and error.code in PERMANENT_TWILIO_ERROR_CODES
+
+def retry_outbox_item(item, error):
+    item["attempts"] += 1
+    if is_permanent_send_error(error):
+        # Leave the appointment flagged as sent so the scheduler doesn't queue it again
+        app.logger.error(f"Dropping message to {item['to']}, Twilio rejected it: {str(error)}")
+        try:
+            get_outbox().delete_one({"_id": item["_id"]})
+        except Exception as e:
+            app.logger.error(f"Failed to clean up outbox message {item['_id']}: {str(e)}")
+        return
+
+    if item["attempts"] < OUTBOX_MAX_ATTEMPTS:
+        delay = OUTBOX_BACKOFF_SECONDS * 2 ** (item["attempts"] - 1)
+        app.logger.warning(f"Failed to send message to {item['to']} (attempt {item['attempts']}), retrying in {delay}s: {str(error)}")
+        threading.Timer(delay, OUTBOX.put, args=[item]).start()
+        return
+
+    app.logger.error(f"Giving up on message to {item['to']} after {item['attempts']} attempts: {str(error)}")
+    try:
+        get_outbox().delete_one({"_id": item["_id"]})
+        if item["field"]:
+            # Let the next scheduler sweep pick the appointment up again
+            get_appointments().update_one({"_id": item["appointment_id"]}, {"$set": {item["field"]: False}})
+    except Exception as e:
+        app.logger.error(f"Failed to clean up outbox message {item['_id']}: {str(e)}")
+
+def flush_sent_outbox(sent, sent_lock):
+    with sent_lock:
+        ids = sent[:]
+        del sent[:]
+    if ids:
+        try:
+            get_outbox().delete_many({"_id": {"$in": ids}})
+        except Exception as e:
+            app.logger.error(f"Failed to clear {len(ids)} sent outbox messages: {str(e)}")
+
+def dispatch_outbox():
+    twilio_client = get_twilio()
+    sent = []
+    sent_lock = threading.Lock()
+    last_renewal = time.monotonic()
+
+    def on_done(future, item):
+        try:
+            message = future.result()
+        except Exception as e:
+            retry_outbox_item(item, e)
+            return
+        app.logger.info(f"Sent message to {item['to']} (sid={message.sid}).")
+        with sent_lock:
+            sent.append(item["_id"])
+
+    with ThreadPoolExecutor(max_workers=SEND_MAX_WORKERS) as executor:
+        while True:
+            # Sent entries are cleared in bulk; the timeout keeps that going while the queue is idle
+            flush_sent_outbox(sent, sent_lock)
+            if time.monotonic() - last_renewal >= OUTBOX_LEASE_RENEW_SECONDS:
+                renew_outbox_leases()
+                last_renewal = time.monotonic()
+            try:
+                batch = [OUTBOX.get(timeout=OUTBOX_FLUSH_SECONDS)]
+            except queue.Empty:
+                continue
+            while len(batch) < OUTBOX_BATCH_SIZE:
+                try:
+                    batch.append(OUTBOX.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Results are handled as each send finishes, so one slow request never holds up the next batch
+            for item in batch:
+                OUTBOX_BUCKET.acquire()
+                future = executor.submit(send_outbox_item, twilio_client, item)
+                future.add_done_callback(lambda future, item=item: on_done(future, item))
+
+# Per-phone cache of the next upcoming appointment. It is process-local and only
+# invalidated by the process that books or cancels, so it defaults to on only for a
+# single webhook worker; with several, another worker could answer from a stale entry.
+UPCOMING_CACHE_ENABLED = os.getenv('UPCOMING_CACHE_ENABLED', '1' if WEB_CONCURRENCY == 1 else '0') == '1'
+upcoming_cache = TTLCache(maxsize=10_000, ttl=60)
+upcoming_cache_lock = threading.Lock()
+NO_UPCOMING = object()
+
+def get_upcoming(phone_number):
+    now = datetime.now()
+    if UPCOMING_CACHE_ENABLED:
+        with upcoming_cache_lock:
+            cached = upcoming_cache.get(phone_number)
+        if cached is NO_UPCOMING:
+            return None
+        if cached is not None and cached["appointment_date"] >= now:
+            return cached
+
+    appointment = get_appointments().find_one(
+        {"phone_number": phone_number, "appointment_date": {"$gte": now}},
+        sort=[("appointment_date", pymongo.ASCENDING)]
+    )
+    if UPCOMING_CACHE_ENABLED:
+        with upcoming_cache_lock:
+            upcoming_cache[phone_number] = appointment if appointment is not None else NO_UPCOMING
+    return appointment
+
+def invalidate_upcoming(phone_number):
+    with upcoming_cache_lock:
+        upcoming_cache.pop(phone_number, None)
+
+# (sender, message) pairs seen in the last few seconds, so a user repeating the
+# same bad input doesn't produce a log line per message
+recent_bad_messages = TTLCache(maxsize=10_000, ttl=5)
+recent_bad_messages_lock = threading.Lock()
 
-# Twilio request validation
-validator = RequestValidator(auth_token)
+def is_repeat_bad_message(sender_number, incoming_msg):
+    key = (sender_number, incoming_msg)
+    with recent_bad_messages_lock:
+        if key in recent_bad_messages:
+            return True
+        recent_bad_messages[key] = True
+        return False
 
 def validate_twilio_request(request):
     # Get the full URL of the request
@@ -54,7 +469,7 @@ def validate_twilio_request(request):
     app.logger.debug(f"Validating request: URL={url}, Signature={signature}")
 
     # Validate the request
-    if not validator.validate(url, post_data, signature):
+    if not get_validator().validate(url, post_data, signature):
         app.logger.warning('Invalid Twilio request')
         app.logger.debug(f"Request details: URL={url}, POST data={post_data}, Signature={signature}")
         return False
@@ -62,47 +477,133 @@ def validate_twilio_request(request):
         app.logger.debug('Twilio request validated successfully')
         return True
 
-def send_interactive_message(to, message, buttons):
-    try:
-        if len(buttons) > 3:
-            app.logger.warning(f"Too many buttons provided ({len(buttons)}). Limiting to 3.")
-            buttons = buttons[:3]  # WhatsApp allows only up to 3 quick reply buttons
-
-        interactive_message = {
-            "type": "interactive",
-            "interactive": {
-                "type": "button",
-                "body": {
-                    "text": message
-                },
-                "action": {
-                    "buttons": [
-                        {
-                            "type": "reply",
-                            "reply": {
-                                "id": button["reply"]["id"],
-                                "title": button["reply"]["title"]
-                            }
-                        } for button in buttons
-                    ]
-                }
+@lru_cache(maxsize=128)
+def build_persistent_actions(button_ids, button_titles):
+    # Cached per button set, so callers must not mutate the returned list
+    return [
+        {
+            "type": "reply",
+            "action": {
+                "title": button_title,
+                "payload": button_id
             }
-        }
+        } for button_id, button_title in zip(button_ids, button_titles)
+    ]
 
-        # Send the interactive message using Twilio's API
-        message = twilio_client.messages.create(
-            from_='whatsapp:+14155238886',  # Your Twilio WhatsApp number
-            to=to,  # Recipient WhatsApp number
-            body=json.dumps(interactive_message)  # Send the interactive button structure
-        )
-        
-        app.logger.info(f"Sent interactive message to {to} with {len(buttons)} buttons")
-        return message.sid
+def send_single_interactive_message(to, message, buttons=None, persistent_actions=None):
+    try:
+        if persistent_actions is None:
+            # Limit the buttons to a maximum of 2 as per Twilio's restrictions
+            if len(buttons) > 2:
+                app.logger.warning(f"Too many buttons provided ({len(buttons)}). Limiting to 2.")
+                buttons = buttons[:2]
+
+            persistent_actions = build_persistent_actions(
+                tuple(button["reply"]["id"] for button in buttons),
+                tuple(button["reply"]["title"] for button in buttons)
+            )
+
+        enqueue_message(to, message, persistent_action=persistent_actions)
+        app.logger.info(f"Queued single interactive message to {to} with {len(persistent_actions)} buttons")
+        return True
     except Exception as e:
-        app.logger.error(f"Failed to send interactive message: {str(e)}")
+        app.logger.error(f"Failed to queue single interactive message: {str(e)}")
         return None
 
-    
+GREETING_MESSAGE = "Welcome to our appointment booking service! How can we help you today?"
+GREETING_BUTTONS = (
+    {"reply": {"id": "book_now", "title": "Book Now"}},
+    {"reply": {"id": "book_later", "title": "Book Later"}},
+    # {"reply": {"id": "cancel_booking", "title": "Cancel Booking"}}
+)
+# The greeting buttons never change, so their payload is built once at import
+GREETING_PERSISTENT_ACTIONS = build_persistent_actions(
+    tuple(button["reply"]["id"] for button in GREETING_BUTTONS),
+    tuple(button["reply"]["title"] for button in GREETING_BUTTONS)
+)
+
+def handle_greeting(sender_number, incoming_msg, msg):
+    send_single_interactive_message(sender_number, GREETING_MESSAGE, persistent_actions=GREETING_PERSISTENT_ACTIONS)
+
+def handle_book(sender_number, incoming_msg, msg):
+    msg.body("What service would you like to book? (e.g., Haircut, Consultation, etc.)")
+    app.logger.debug(f"Asked {sender_number} for service type.")
+
+def handle_book_later(sender_number, incoming_msg, msg):
+    msg.body("No problem! When you're ready to book, just type 'book' and we'll assist you.")
+    app.logger.debug(f"{sender_number} chose to book later.")
+
+def handle_cancel(sender_number, incoming_msg, msg):
+    existing_appointment = get_upcoming(sender_number)
+    if existing_appointment:
+        get_appointments().delete_one({"_id": existing_appointment["_id"]})
+        invalidate_upcoming(sender_number)
+        msg.body(f"Your appointment for {existing_appointment['service']} on {existing_appointment['appointment_date']} has been cancelled.")
+        app.logger.info(f"Cancelled appointment for {sender_number}")
+    else:
+        msg.body("You don't have any upcoming appointments to cancel.")
+    app.logger.debug(f"{sender_number} attempted to cancel a booking.")
+
+def handle_service(sender_number, incoming_msg, msg):
+    service = incoming_msg.title()
+    msg.body(f"When would you like to schedule your {service}? Please provide the date and time in this format: YYYY-MM-DD HH:MM.")
+    app.logger.debug(f"{sender_number} is booking a {service}.")
+
+DATE_INPUT_RE = re.compile(r'\d{4}-\d{2}-\d{2} \d{2}:\d{2}')
+
+def parse_appointment_date(value):
+    # Fixed YYYY-MM-DD HH:MM layout, so slice the fields instead of going through strptime
+    if not DATE_INPUT_RE.fullmatch(value):
+        raise ValueError(f"time data {value!r} does not match format 'YYYY-MM-DD HH:MM'")
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]))
+
+def handle_date(sender_number, incoming_msg, msg, service=''):
+    try:
+        appointment_date = parse_appointment_date(incoming_msg)
+        if appointment_date < datetime.now():
+            raise ValueError("Appointment date is in the past")
+
+        app.logger.info(f"Scheduling {service} for {sender_number} on {appointment_date}.")
+
+        get_appointments().insert_one({
+            "customer_name": "Customer",  # Replace with a way to get the customer's name
+            "phone_number": sender_number,
+            "service": service,
+            "appointment_date": appointment_date,
+            "reminder_sent": False,
+            "follow_up_sent": False,
+            "reminder_due_at": appointment_date - REMINDER_LEAD_TIME,
+            "follow_up_due_at": appointment_date
+        })
+        invalidate_upcoming(sender_number)
+        msg.body(f"Your {service} is scheduled for {appointment_date}. You will receive a reminder 24 hours before the appointment.")
+    except ValueError as e:
+        msg.body(f"Invalid date format or date is in the past. Please use YYYY-MM-DD HH:MM for a future date and time.")
+        if not is_repeat_bad_message(sender_number, incoming_msg):
+            app.logger.error(f"Invalid date format provided by {sender_number}: {incoming_msg}. Error: {str(e)}")
+
+# Messages are tokenized once and matched against fixed keyword sets, in priority order
+TOKEN_RE = re.compile(r'\w+')
+GREETINGS = frozenset({"hi", "hello"})
+BOOK_TOKENS = frozenset({"book", "book_now"})
+BOOK_LATER_TOKENS = frozenset({"book_later"})
+CANCEL_TOKENS = frozenset({"cancel_booking"})
+SERVICE_TOKENS = frozenset({"haircut", "consultation"})
+INTENTS = (
+    (GREETINGS, handle_greeting),
+    (BOOK_TOKENS, handle_book),
+    (BOOK_LATER_TOKENS, handle_book_later),
+    (CANCEL_TOKENS, handle_cancel),
+    (SERVICE_TOKENS, handle_service),
+)
+
+def match_intent(incoming_msg):
+    tokens = frozenset(TOKEN_RE.findall(incoming_msg))
+    for intent_tokens, handler in INTENTS:
+        if tokens & intent_tokens:
+            return handler
+    return None
+
 @app.route("/whatsapp", methods=['POST'])
 def whatsapp_reply():
     if not validate_twilio_request(request):
@@ -119,58 +620,15 @@ def whatsapp_reply():
     msg = response.message()
 
     try:
-        if 'hi' in incoming_msg or 'hello' in incoming_msg:
-            greeting_msg = "Welcome to our appointment booking service! How can we help you today?"
-            buttons = [
-                {"reply": {"id": "book_now", "title": "Book Now"}},
-                {"reply": {"id": "book_later", "title": "Book Later"}},
-                # {"reply": {"id": "cancel_booking", "title": "Cancel Booking"}}
-            ]
-            send_interactive_message(sender_number, greeting_msg, buttons)
-            return str(response)
-
-        elif 'book_now' in incoming_msg or 'book' in incoming_msg:
-            msg.body("What service would you like to book? (e.g., Haircut, Consultation, etc.)")
-            app.logger.debug(f"Asked {sender_number} for service type.")
-        elif 'book_later' in incoming_msg:
-            msg.body("No problem! When you're ready to book, just type 'book' and we'll assist you.")
-            app.logger.debug(f"{sender_number} chose to book later.")
-        elif 'cancel_booking' in incoming_msg:
-            existing_appointment = appointments.find_one({"phone_number": sender_number, "appointment_date": {"$gte": datetime.now()}})
-            if existing_appointment:
-                appointments.delete_one({"_id": existing_appointment["_id"]})
-                msg.body(f"Your appointment for {existing_appointment['service']} on {existing_appointment['appointment_date']} has been cancelled.")
-                app.logger.info(f"Cancelled appointment for {sender_number}")
-            else:
-                msg.body("You don't have any upcoming appointments to cancel.")
-            app.logger.debug(f"{sender_number} attempted to cancel a booking.")
-        elif 'haircut' in incoming_msg or 'consultation' in incoming_msg:
-            service = incoming_msg.title()
-            msg.body(f"When would you like to schedule your {service}? Please provide the date and time in this format: YYYY-MM-DD HH:MM.")
-            app.logger.debug(f"{sender_number} is booking a {service}.")
+        handler = match_intent(incoming_msg)
+        if handler:
+            handler(sender_number, incoming_msg, msg)
         elif len(incoming_msg) == 16:  # Assuming date and time input
-            try:
-                appointment_date = datetime.strptime(incoming_msg, '%Y-%m-%d %H:%M')
-                if appointment_date < datetime.now():
-                    raise ValueError("Appointment date is in the past")
-                
-                app.logger.info(f"Scheduling {service} for {sender_number} on {appointment_date}.")
-                
-                appointments.insert_one({
-                    "customer_name": "Customer",  # Replace with a way to get the customer's name
-                    "phone_number": sender_number,
-                    "service": service,
-                    "appointment_date": appointment_date,
-                    "reminder_sent": False,
-                    "follow_up_sent": False
-                })
-                msg.body(f"Your {service} is scheduled for {appointment_date}. You will receive a reminder 24 hours before the appointment.")
-            except ValueError as e:
-                msg.body(f"Invalid date format or date is in the past. Please use YYYY-MM-DD HH:MM for a future date and time.")
-                app.logger.error(f"Invalid date format provided by {sender_number}: {incoming_msg}. Error: {str(e)}")
+            handle_date(sender_number, incoming_msg, msg, service)
         else:
             msg.body("I didn't understand that. Type 'hi' for options or 'book' to book an appointment.")
-            app.logger.warning(f"Unrecognized message from {sender_number}: {incoming_msg}")
+            if not is_repeat_bad_message(sender_number, incoming_msg):
+                app.logger.warning(f"Unrecognized message from {sender_number}: {incoming_msg}")
     
     except Exception as e:
         app.logger.error(f"Error processing message from {sender_number}: {str(e)}")
@@ -178,60 +636,220 @@ def whatsapp_reply():
 
     return str(response)
 
+def flush_updates(updates):
+    if not updates:
+        return
+    try:
+        result = get_appointments().bulk_write(updates, ordered=False)
+        app.logger.debug(f"Marked {result.modified_count} appointments as sent.")
+    except Exception as e:
+        app.logger.error(f"Failed to mark {len(updates)} appointments as sent: {str(e)}")
+
+def queue_appointment_messages(appointments, build_message, field, label):
+    # Appointments are marked as sent once their message is in the outbox; if
+    # delivery finally fails the dispatcher resets the flag for the next sweep.
+    items = []
+    updates = []
+    for appointment in appointments:
+        items.append(outbox_item(
+            appointment['phone_number'],
+            build_message(appointment),
+            appointment_id=appointment['_id'],
+            field=field
+        ))
+        updates.append(pymongo.UpdateOne({"_id": appointment['_id']}, {"$set": {field: True}}))
+
+        if len(items) >= BULK_WRITE_BATCH_SIZE:
+            enqueue_messages(items)
+            flush_updates(updates)
+            app.logger.info(f"Queued {len(items)} {label} messages.")
+            items = []
+            updates = []
+
+    if items:
+        enqueue_messages(items)
+        flush_updates(updates)
+        app.logger.info(f"Queued {len(items)} {label} messages.")
+
+def reminder_message(appointment):
+    return f"Reminder: Your {appointment['service']} appointment is scheduled for {appointment['appointment_date']}."
+
+def follow_up_message(appointment):
+    return f"Hope you enjoyed your {appointment['service']}! Let us know if you need anything else."
+
 def send_reminder():
     app.logger.info("Running reminder job.")
     now = datetime.now()
-    reminder_appointments = appointments.find({
-        "appointment_date": {
-            "$gte": now + timedelta(hours=23),
-            "$lte": now + timedelta(hours=25)
-        },
-        "reminder_sent": False
-    })
-    
-    for appointment in reminder_appointments:
-        try:
-            message = f"Reminder: Your {appointment['service']} appointment is scheduled for {appointment['appointment_date']}."
-            twilio_client.messages.create(
-                body=message,
-                from_='whatsapp:+14155238886',
-                to=appointment['phone_number']
-            )
-            app.logger.info(f"Sent reminder to {appointment['phone_number']} for {appointment['service']} on {appointment['appointment_date']}.")
-            appointments.update_one({"_id": appointment["_id"]}, {"$set": {"reminder_sent": True}})
-        except Exception as e:
-            app.logger.error(f"Failed to send reminder to {appointment['phone_number']}: {str(e)}")
+    reminder_appointments = get_appointments().find({
+        "reminder_sent": False,
+        "reminder_due_at": {"$lte": now},
+        "appointment_date": {"$gt": now}
+    }, projection=APPOINTMENT_PROJECTION).hint(REMINDER_INDEX).batch_size(SCAN_BATCH_SIZE)
+
+    queue_appointment_messages(
+        reminder_appointments,
+        reminder_message,
+        "reminder_sent",
+        "reminder"
+    )
 
 def send_follow_up():
     app.logger.info("Running follow-up job.")
     now = datetime.now()
-    follow_up_appointments = appointments.find({
-        "appointment_date": {
-            "$gte": now - timedelta(hours=24),
-            "$lte": now
-        },
-        "follow_up_sent": False
-    })
-    
-    for appointment in follow_up_appointments:
+    follow_up_appointments = get_appointments().find({
+        "follow_up_sent": False,
+        "follow_up_due_at": {"$gte": now - FOLLOW_UP_WINDOW, "$lte": now}
+    }, projection=APPOINTMENT_PROJECTION).hint(FOLLOW_UP_INDEX).batch_size(SCAN_BATCH_SIZE)
+
+    queue_appointment_messages(
+        follow_up_appointments,
+        follow_up_message,
+        "follow_up_sent",
+        "follow-up"
+    )
+
+def send_one_reminder(appointment_id):
+    # Claiming the flag atomically keeps a reseed and the change stream from double sending
+    appointment = get_appointments().find_one_and_update(
+        {"_id": appointment_id, "reminder_sent": False, "appointment_date": {"$gt": datetime.now()}},
+        {"$set": {"reminder_sent": True}},
+        projection=APPOINTMENT_PROJECTION
+    )
+    if appointment:
+        enqueue_message(appointment['phone_number'], reminder_message(appointment), appointment_id=appointment_id, field="reminder_sent")
+        app.logger.info(f"Queued reminder for appointment {appointment_id}.")
+
+def send_one_follow_up(appointment_id):
+    appointment = get_appointments().find_one_and_update(
+        {"_id": appointment_id, "follow_up_sent": False, "appointment_date": {"$gte": datetime.now() - FOLLOW_UP_WINDOW}},
+        {"$set": {"follow_up_sent": True}},
+        projection=APPOINTMENT_PROJECTION
+    )
+    if appointment:
+        enqueue_message(appointment['phone_number'], follow_up_message(appointment), appointment_id=appointment_id, field="follow_up_sent")
+        app.logger.info(f"Queued follow-up for appointment {appointment_id}.")
+
+def schedule_appointment_jobs(scheduler, appointment):
+    # Past due times run right away, and jobs held up by a busy scheduler still run late
+    # instead of being dropped as misfires
+    now = datetime.now()
+    if not appointment.get("reminder_sent") and appointment.get("reminder_due_at"):
+        scheduler.add_job(send_one_reminder, 'date', run_date=max(appointment["reminder_due_at"], now),
+                          args=[appointment["_id"]], id=f"reminder:{appointment['_id']}", replace_existing=True,
+                          misfire_grace_time=None)
+    if not appointment.get("follow_up_sent") and appointment.get("follow_up_due_at"):
+        scheduler.add_job(send_one_follow_up, 'date', run_date=max(appointment["follow_up_due_at"], now),
+                          args=[appointment["_id"]], id=f"follow_up:{appointment['_id']}", replace_existing=True,
+                          misfire_grace_time=None)
+
+def seed_appointment_jobs(scheduler):
+    # Picks up rows the change stream missed (downtime, failed sends reset to unsent)
+    appointments = get_appointments()
+    now = datetime.now()
+    horizon = now + SEED_HORIZON
+    projection = {"_id": 1, "reminder_sent": 1, "reminder_due_at": 1}
+    for appointment in appointments.find({
+        "reminder_sent": False,
+        "reminder_due_at": {"$lte": horizon},
+        "appointment_date": {"$gt": now}
+    }, projection=projection).hint(REMINDER_INDEX).batch_size(SCAN_BATCH_SIZE):
+        schedule_appointment_jobs(scheduler, appointment)
+
+    projection = {"_id": 1, "follow_up_sent": 1, "follow_up_due_at": 1}
+    for appointment in appointments.find({
+        "follow_up_sent": False,
+        "follow_up_due_at": {"$gte": now - FOLLOW_UP_WINDOW, "$lte": horizon}
+    }, projection=projection).hint(FOLLOW_UP_INDEX).batch_size(SCAN_BATCH_SIZE):
+        schedule_appointment_jobs(scheduler, appointment)
+
+def start_polling(scheduler):
+    scheduler.add_job(send_reminder, 'interval', minutes=1, id="send_reminder", replace_existing=True)
+    scheduler.add_job(send_follow_up, 'interval', minutes=1, id="send_follow_up", replace_existing=True)
+
+def open_appointment_stream(resume_token=None):
+    return get_appointments().watch([{"$match": {"operationType": "insert"}}], resume_after=resume_token)
+
+def watch_new_appointments(scheduler, stream):
+    resume_token = None
+    reseed = False
+    while True:
         try:
-            message = f"Hope you enjoyed your {appointment['service']}! Let us know if you need anything else."
-            twilio_client.messages.create(
-                body=message,
-                from_='whatsapp:+14155238886',
-                to=appointment['phone_number']
-            )
-            app.logger.info(f"Sent follow-up to {appointment['phone_number']} for {appointment['service']} on {appointment['appointment_date']}.")
-            appointments.update_one({"_id": appointment["_id"]}, {"$set": {"follow_up_sent": True}})
+            if reseed:
+                seed_appointment_jobs(scheduler)
+                reseed = False
+            if stream is None:
+                stream = open_appointment_stream(resume_token)
+            with stream:
+                app.logger.info("Watching for new appointments.")
+                for change in stream:
+                    resume_token = stream.resume_token
+                    schedule_appointment_jobs(scheduler, change["fullDocument"])
+        except pymongo.errors.OperationFailure as e:
+            if e.code == CHANGE_STREAM_HISTORY_LOST:
+                # The resume point is gone from the oplog; reseed so nothing inserted meanwhile is lost
+                app.logger.error(f"Change stream could not resume, reseeding: {str(e)}")
+                resume_token = None
+                reseed = True
+            else:
+                app.logger.error(f"Change stream failed, retrying: {str(e)}")
         except Exception as e:
-            app.logger.error(f"Failed to send follow-up to {appointment['phone_number']}: {str(e)}")
+            app.logger.error(f"Change stream interrupted, reconnecting: {str(e)}")
+        stream = None
+        # Every failure waits before the next attempt so a persistent error can't spin
+        time.sleep(CHANGE_STREAM_RETRY_SECONDS)
+
+def start_scheduler():
+    ensure_indexes()
+    ensure_outbox_indexes()
+    backfill_due_dates()
+
+    # Nothing is started until every Mongo call has succeeded, so a failed attempt can simply be retried
+    scheduler = GeventScheduler()
+    try:
+        stream = open_appointment_stream()
+    except pymongo.errors.OperationFailure as e:
+        # Change streams need a replica set; a standalone mongod only gets the minute sweeps,
+        # never the per-appointment jobs, so the two send paths can't overlap
+        app.logger.warning(f"Change stream unavailable, falling back to polling: {str(e)}")
+        stream = None
+
+    try:
+        if stream is None:
+            start_polling(scheduler)
+        else:
+            seed_appointment_jobs(scheduler)
+            scheduler.add_job(seed_appointment_jobs, 'interval', hours=1, args=[scheduler], id="seed_appointment_jobs")
+        recover_outbox()
+        scheduler.add_job(recover_outbox, 'interval', minutes=OUTBOX_RECOVERY_MINUTES, id="recover_outbox")
+    except Exception:
+        if stream is not None:
+            stream.close()
+        raise
 
-if __name__ == "__main__":
-    # Set up scheduler
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(send_reminder, 'interval', minutes=1)
-    scheduler.add_job(send_follow_up, 'interval', minutes=1)
     scheduler.start()
+    OUTBOX_BUCKET.set_rate(worker_send_rate(runs_scheduler=True))
+    if stream is not None:
+        threading.Thread(target=watch_new_appointments, args=[scheduler, stream], name="appointment-watcher", daemon=True).start()
+    app.logger.info(f"Scheduler started in process {os.getpid()}.")
+    return scheduler
+
+def start_scheduler_with_retry():
+    while True:
+        try:
+            return start_scheduler()
+        except Exception as e:
+            app.logger.error(f"Failed to start scheduler, retrying in {SCHEDULER_RETRY_SECONDS}s: {str(e)}")
+            time.sleep(SCHEDULER_RETRY_SECONDS)
+
+def start_scheduler_in_background():
+    # Startup talks to Mongo; doing it off the caller keeps a Mongo outage from blocking worker boot
+    return gevent.spawn(start_scheduler_with_retry)
+
+if __name__ == "__main__":
+    from gevent.pywsgi import WSGIServer
+
+    if RUN_SCHEDULER:
+        start_scheduler_in_background()
 
-    # Run the Flask app
-    app.run(host="0.0.0.0", port=int(os.getenv('PORT', 5000)), debug=True)
+    # Single-process run; use gunicorn (see gunicorn.conf.py) in production
+    WSGIServer(("0.0.0.0", int(os.getenv('PORT', 5000))), app).serve_forever()
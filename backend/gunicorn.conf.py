@@ -0,0 +1,32 @@
+# gunicorn -c gunicorn.conf.py app:app
+import fcntl
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 5000)}"
+worker_class = "gevent"
+# Exported so the workers can split the Twilio send rate between them
+workers = int(os.environ.setdefault('WEB_CONCURRENCY', '4'))
+worker_connections = 1000
+
+SCHEDULER_LOCK_PATH = os.getenv('SCHEDULER_LOCK_PATH', '/tmp/appointment_bot_scheduler.lock')
+
+def post_worker_init(worker):
+    # gunicorn halts the whole server if this hook raises, so errors are only logged
+    try:
+        import app
+        if not app.RUN_SCHEDULER:
+            return
+
+        # Only the worker holding the lock runs the reminder/follow-up jobs. The lock is
+        # released when that worker exits, so its replacement picks the jobs back up.
+        lock = open(SCHEDULER_LOCK_PATH, 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return
+
+        worker.scheduler_lock = lock
+        app.start_scheduler_in_background()
+    except Exception:
+        worker.log.exception("Failed to start the scheduler")